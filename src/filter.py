@@ -1,32 +1,120 @@
 import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 import geopandas as gpd
-from shapely.ops import unary_union
+import numpy as np
+import pandas as pd
+import pyogrio
+import shapely
+
+# Read/write through GDAL's bulk array interface rather than Fiona's per-feature path
+gpd.options.io_engine = "pyogrio"
 
 REPO_ROOT = Path(__file__).resolve().parent.parent
 
+# Number of features read per Arrow batch when streaming input files
+STREAM_BATCH_SIZE = 50_000
+
+
+def _batch_to_geodataframe(batch, meta):
+    """Converts an Arrow batch/table from pyogrio.open_arrow into a GeoDataFrame."""
+    df = batch.to_pandas()
+    geometry_name = meta["geometry_name"] or "wkb_geometry"
+    geometry = shapely.from_wkb(df.pop(geometry_name).to_numpy())
+    return gpd.GeoDataFrame(df, geometry=geometry, crs=meta["crs"])
+
+
+def _filter_file(input_path, output_path, buffer_wkb, crs_metric):
+    """Filters one GeoJSON file against the buffer zone; returns (original, filtered) counts.
+
+    The buffer's bounding box is pushed down to the OGR reader, so features
+    whose envelopes fall outside it are skipped without building geometries.
+    Survivors are streamed in Arrow batches of STREAM_BATCH_SIZE, so only the
+    current batch and the features that pass the filter are held in memory.
+    """
+    buffer_zone = shapely.from_wkb(buffer_wkb)
+    # Build the GEOS prepared-geometry index once; it is reused by every batch
+    shapely.prepare(buffer_zone)
+
+    info = pyogrio.read_info(input_path)
+    original_count = info["features"]
+    # Densify before reprojecting so the bbox still covers the curved edges
+    bbox = (
+        gpd.GeoSeries([shapely.segmentize(buffer_zone, 100)], crs=crs_metric)
+        .to_crs(info["crs"])
+        .total_bounds
+    )
+
+    kept = []
+    with pyogrio.open_arrow(
+        input_path, bbox=tuple(bbox), batch_size=STREAM_BATCH_SIZE, use_pyarrow=True
+    ) as (meta, reader):
+        for batch in reader:
+            gdf_proj = _batch_to_geodataframe(batch, meta).to_crs(epsg=crs_metric)
+            # Spatial index query: bounding-box prefilter, then the exact predicate
+            # only on candidates (within() implies intersects(), so one pass is enough)
+            matches = gdf_proj.sindex.query(buffer_zone, predicate="intersects")
+            kept.append(gdf_proj.iloc[np.sort(matches)])
+        if not kept:
+            kept.append(_batch_to_geodataframe(reader.schema.empty_table(), meta))
+
+    gdf_filtered = pd.concat(kept, ignore_index=True)
+    gdf_filtered = gdf_filtered.to_crs(epsg=4326)
+    gdf_filtered.to_file(output_path, driver="GeoJSON")
+    return original_count, len(gdf_filtered)
+
+
+def _is_up_to_date(output_path, *source_paths):
+    """True if output_path exists and is newer than every source path."""
+    if not os.path.exists(output_path):
+        return False
+    output_mtime = os.path.getmtime(output_path)
+    return all(os.path.getmtime(p) < output_mtime for p in source_paths)
+
 
 def filter_geojson_by_distance(
     neighborhoods_path,
     data_folder,
     output_folder,
     max_distance_km=10,
+    max_workers=None,
+    use_cache=True,
 ):
-    """Filter all GeoJSON files to only include features within max_distance_km from neighborhoods."""
+    """Filter all GeoJSON files to only include features within max_distance_km from neighborhoods.
+
+    Files are independent, so they are filtered in parallel worker processes
+    (max_workers defaults to the number of CPUs).
+
+    With use_cache, the buffer zone is stored as WKB in the output folder and
+    reused while the neighborhoods file and this module are unchanged, and
+    files whose output is newer than both their input and the buffer are
+    skipped.
+    """
     os.makedirs(output_folder, exist_ok=True)
 
     # Israeli Transverse Mercator (meters), same as preprocess_accessibility.py
     crs_metric = 2039
     print("Loading neighborhoods...")
     neighborhoods = gpd.read_file(neighborhoods_path)
-    neighborhoods_proj = neighborhoods.to_crs(epsg=crs_metric)
-
-    max_distance_m = max_distance_km * 1000
-    neighborhoods_union = unary_union(neighborhoods_proj.geometry)
-    buffer_zone = neighborhoods_union.buffer(max_distance_m)
 
-    print(f"Created {max_distance_km}km buffer around neighborhoods")
+    buffer_cache = Path(output_folder) / f".buffer_{max_distance_km}km.wkb"
+    # This module defines how the zone is built, so edits to it invalidate the cache too
+    if use_cache and _is_up_to_date(buffer_cache, neighborhoods_path, __file__):
+        buffer_wkb = buffer_cache.read_bytes()
+        print(f"Reusing cached {max_distance_km}km buffer around neighborhoods")
+    else:
+        neighborhoods_proj = neighborhoods.to_crs(epsg=crs_metric)
+        max_distance_m = max_distance_km * 1000
+        neighborhoods_union = shapely.union_all(neighborhoods_proj.geometry.values)
+        buffer_zone = shapely.buffer(neighborhoods_union, max_distance_m)
+        # Serialized once so workers don't have to re-union the neighborhoods
+        buffer_wkb = shapely.to_wkb(buffer_zone)
+        # Drop buffers cached for other distances so switching back rebuilds everything
+        for stale in Path(output_folder).glob(".buffer_*km.wkb"):
+            stale.unlink()
+        buffer_cache.write_bytes(buffer_wkb)
+        print(f"Created {max_distance_km}km buffer around neighborhoods")
 
     geojson_files = [
         f
@@ -35,28 +123,30 @@ def filter_geojson_by_distance(
     ]
     print(f"\nFound {len(geojson_files)} GeoJSON files to filter")
 
-    for filename in geojson_files:
-        input_path = os.path.join(data_folder, filename)
-        output_path = os.path.join(output_folder, filename)
-        print(f"\nProcessing {filename}...")
-
-        try:
-            gdf = gpd.read_file(input_path)
-            original_count = len(gdf)
-            gdf_proj = gdf.to_crs(epsg=crs_metric)
-            gdf_filtered = gdf_proj[
-                gdf_proj.geometry.within(buffer_zone)
-                | gdf_proj.geometry.intersects(buffer_zone)
-            ]
-            gdf_filtered = gdf_filtered.to_crs(epsg=4326)
-            filtered_count = len(gdf_filtered)
-            removed_count = original_count - filtered_count
-            gdf_filtered.to_file(output_path, driver="GeoJSON")
-            print(f"  Original features: {original_count}")
-            print(f"  Filtered features: {filtered_count}")
-            print(f"  Removed features: {removed_count} ({removed_count/original_count*100:.1f}%)")
-        except Exception as e:
-            print(f"  Error processing {filename}: {str(e)}")
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for filename in geojson_files:
+            input_path = os.path.join(data_folder, filename)
+            output_path = os.path.join(output_folder, filename)
+            if use_cache and _is_up_to_date(output_path, input_path, buffer_cache):
+                futures[filename] = None
+                continue
+            futures[filename] = executor.submit(
+                _filter_file, input_path, output_path, buffer_wkb, crs_metric
+            )
+        for filename, future in futures.items():
+            print(f"\nProcessing {filename}...")
+            if future is None:
+                print("  Output is up to date, skipping")
+                continue
+            try:
+                original_count, filtered_count = future.result()
+                removed_count = original_count - filtered_count
+                print(f"  Original features: {original_count}")
+                print(f"  Filtered features: {filtered_count}")
+                print(f"  Removed features: {removed_count} ({removed_count/original_count*100:.1f}%)")
+            except Exception as e:
+                print(f"  Error processing {filename}: {str(e)}")
 
     neighborhoods_output = os.path.join(output_folder, "neighborhoods.geojson")
     neighborhoods.to_file(neighborhoods_output, driver="GeoJSON")
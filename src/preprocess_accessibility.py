@@ -19,7 +19,13 @@ for handler in logging.root.handlers:
     handler.addFilter(_ProjFilter())
 
 import geopandas as gpd
+import numpy as np
 import pandas as pd
+import pyogrio
+import shapely
+
+# Read/write through GDAL's bulk array interface rather than Fiona's per-feature path
+gpd.options.io_engine = "pyogrio"
 
 REPO_ROOT = Path(__file__).resolve().parent.parent
 DATA_DIR = REPO_ROOT / "data"
@@ -61,6 +67,16 @@ EXCLUDED_AMENITY_TYPES = {"none", "other", "private_establishment"}
 BUILDING_SIMPLIFY_TOLERANCE_M = 1.5  # 1.5 meter tolerance for buildings (good balance of size/detail)
 PARK_SIMPLIFY_TOLERANCE_M = 2.0  # Parks can use higher tolerance since they're larger shapes
 
+# Amenities matched against building buffers per chunk (bounds peak memory)
+AMENITY_CHUNK_SIZE = 50_000
+
+# Characters that mark Mojibake from double UTF-8 encoding:
+# - Hebrew double-encoded UTF-8 typically contains ×
+# - Arabic double-encoded UTF-8 typically contains Ø
+# - Other RTL scripts may have similar patterns with Ù, Ú, etc.
+MOJIBAKE_INDICATORS = ("×", "Ø", "Ù", "Ú", "Û", "Ü")
+MOJIBAKE_PATTERN = "[" + "".join(MOJIBAKE_INDICATORS) + "]"
+
 
 def repair_text_encoding(text: str) -> str:
     """Attempts to repair garbled text (Mojibake from double UTF-8 encoding).
@@ -74,13 +90,8 @@ def repair_text_encoding(text: str) -> str:
     if not isinstance(text, str) or not text:
         return text
     
-    # Check if text contains Mojibake patterns:
-    # - Hebrew double-encoded UTF-8 typically contains ×
-    # - Arabic double-encoded UTF-8 typically contains Ø
-    # - Other RTL scripts may have similar patterns with Ù, Ú, etc.
-    mojibake_indicators = ("×", "Ø", "Ù", "Ú", "Û", "Ü")
-    
-    if not any(indicator in text for indicator in mojibake_indicators):
+    # Check if text contains Mojibake patterns (see MOJIBAKE_INDICATORS)
+    if not any(indicator in text for indicator in MOJIBAKE_INDICATORS):
         return text
     
     try:
@@ -102,14 +113,39 @@ repair_hebrew_encoding = repair_text_encoding
 
 
 def repair_dataframe_encoding(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
-    """Repairs text encoding (Hebrew, Arabic, etc.) in string columns of a GeoDataFrame."""
-    gdf = gdf.copy()
+    """Repairs text encoding (Hebrew, Arabic, etc.) in string columns of a GeoDataFrame.
+    
+    Same repair as repair_text_encoding, but vectorized per column: only cells
+    containing a Mojibake indicator are re-encoded, the rest are left untouched.
     
+    The frame is modified in place (no defensive copy) and returned for chaining.
+    """
     for col in gdf.columns:
-        if gdf[col].dtype == object:
-            gdf[col] = gdf[col].apply(
-                lambda x: repair_text_encoding(x) if isinstance(x, str) else x
-            )
+        if gdf[col].dtype != object:
+            continue
+        values = gdf[col]
+        try:
+            mask = values.str.contains(MOJIBAKE_PATTERN, regex=True, na=False)
+        except AttributeError:
+            # Object column without string values
+            continue
+        if not mask.any():
+            # Nothing to repair (ids, ASCII-only types, ...): skip the write-back
+            continue
+        original = values[mask]
+        # One fused pass over the raw object array (every masked cell is a str),
+        # rather than two .str passes with an intermediate Series of bytes
+        repaired = pd.Series(
+            [
+                text.encode("latin-1", errors="ignore").decode("utf-8", errors="ignore")
+                for text in original.to_numpy()
+            ],
+            index=original.index,
+            dtype=object,
+        )
+        # Keep the original text where the repair produced nothing useful
+        failed = (repaired == "") | (repaired == original)
+        gdf.loc[mask, col] = repaired.where(~failed, original)
     
     return gdf
 
@@ -135,7 +171,7 @@ def _unique_columns(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
 
 def load_layer(path: Path, target_crs: int) -> gpd.GeoDataFrame:
     """Loads a GeoJSON/shape layer and reprojects it to target_crs."""
-    gdf = gpd.read_file(path)
+    gdf = gpd.read_file(path, use_arrow=True)
     gdf = _unique_columns(gdf)
     if gdf.crs is None:
         raise ValueError(f"Layer {path} has no CRS defined.")
@@ -175,6 +211,24 @@ def simplify_geometries(gdf: gpd.GeoDataFrame, tolerance_m: float) -> gpd.GeoDat
     return simplified
 
 
+def write_layer(gdf: gpd.GeoDataFrame, path: Path, driver: str = "FlatGeobuf") -> None:
+    """Writes a layer with pyogrio, bulk-writing through GDAL's Arrow API when available.
+    
+    Arrow writes need GDAL >= 3.8; older builds fall back to pyogrio's regular
+    (still batched) writer.
+    """
+    if driver == "FlatGeobuf":
+        # The FlatGeobuf spatial index (on by default) rejects features with a
+        # null or empty geometry and aborts the whole write; such features
+        # can't be drawn anyway, so leave them out, as the web GeoJSON does
+        missing = gdf.geometry.isna() | gdf.geometry.is_empty
+        if missing.any():
+            logging.info("Skipping %d features without geometry in %s", int(missing.sum()), path.name)
+            gdf = gdf[~missing]
+    use_arrow = pyogrio.__gdal_version__ >= (3, 8, 0)
+    pyogrio.write_dataframe(gdf, path, driver=driver, use_arrow=use_arrow)
+
+
 def write_minimal_geojson(gdf: gpd.GeoDataFrame, path: Path, precision: int = 5) -> None:
     """Writes GeoJSON with minimal overhead (no CRS, reduced precision).
     
@@ -226,43 +280,41 @@ def reduce_coordinate_precision(gdf: gpd.GeoDataFrame, precision: int = 6) -> gp
     Returns:
         GeoDataFrame with rounded coordinates
     """
-    from shapely import wkt
-    from shapely.geometry import shape, mapping
-    import json
-    
     reduced = gdf.copy()
-    
-    def round_coords(geom):
-        if geom is None or geom.is_empty:
-            return geom
-        # Convert to GeoJSON, round coordinates, convert back
-        geojson = mapping(geom)
-        rounded = _round_geojson_coords(geojson, precision)
-        return shape(rounded)
-    
-    reduced["geometry"] = reduced.geometry.apply(round_coords)
+    # Snap every coordinate to the decimal grid in one vectorized GEOS call;
+    # "pointwise" only rounds coordinates, like round(), without re-noding
+    reduced["geometry"] = shapely.set_precision(
+        reduced.geometry.values, grid_size=10 ** -precision, mode="pointwise"
+    )
     return reduced
 
 
 def _round_geojson_coords(geojson: dict, precision: int) -> dict:
-    """Recursively rounds coordinates in a GeoJSON geometry dict."""
+    """Rounds coordinates in a GeoJSON geometry dict, walking each geometry type's nesting directly."""
     geom_type = geojson.get("type")
     coords = geojson.get("coordinates")
     
     if coords is None:
         return geojson
     
-    def round_coord(c):
-        if isinstance(c, (list, tuple)):
-            if len(c) >= 2 and isinstance(c[0], (int, float)):
-                # This is a coordinate pair/triple
-                return [round(x, precision) for x in c]
-            else:
-                # This is a list of coordinates or rings
-                return [round_coord(x) for x in c]
-        return c
+    def round_position(c):
+        return [round(x, precision) for x in c]
     
-    return {"type": geom_type, "coordinates": round_coord(coords)}
+    def round_positions(cs):
+        return [[round(x, precision) for x in c] for c in cs]
+    
+    if geom_type == "Point":
+        rounded = round_position(coords)
+    elif geom_type in ("LineString", "MultiPoint"):
+        rounded = round_positions(coords)
+    elif geom_type in ("Polygon", "MultiLineString"):
+        rounded = [round_positions(ring) for ring in coords]
+    elif geom_type == "MultiPolygon":
+        rounded = [[round_positions(ring) for ring in polygon] for polygon in coords]
+    else:
+        return geojson
+    
+    return {"type": geom_type, "coordinates": rounded}
 
 
 def compute_building_accessibility(
@@ -300,86 +352,103 @@ def compute_building_accessibility(
 
     logging.info("Preparing building buffers...")
     buildings = buildings.reset_index(drop=True)
+    # Shapely array predicates run over the GeometryArray in one GEOS pass
+    geoms = np.asarray(buildings.geometry.values)
     with warnings.catch_warnings():
         warnings.simplefilter("ignore", RuntimeWarning)
-        valid = ~buildings.geometry.is_empty
-        try:
-            valid = valid & buildings.geometry.is_valid
-        except Exception:
-            pass
-    buildings = buildings[valid].copy()
+        valid = shapely.is_valid(geoms) & ~shapely.is_empty(geoms)
+    # drop() returns a fresh frame, so no defensive .copy() before adding columns
+    buildings = buildings.drop(index=buildings.index[~valid])
     buildings["building_id"] = buildings.index
     with warnings.catch_warnings():
         warnings.simplefilter("ignore", RuntimeWarning)
-        buildings["buffer_m"] = buildings.geometry.buffer(buffer_m)
+        # quad_segs=16 matches GeoSeries.buffer (shapely's own default is 8)
+        buffers = shapely.buffer(np.asarray(buildings.geometry.values), buffer_m, quad_segs=16)
+    # One STRtree over the buffers, shared by the amenity and tree counts.
+    # query() evaluates predicate(input, buffer) and returns
+    # (input, buffer) position pairs; buffer positions are building rows.
+    buffer_tree = shapely.STRtree(buffers)
 
     logging.info("Preparing amenities with type classification...")
-    amenities = amenities.copy()
     if amenity_type_column not in amenities.columns:
         raise KeyError(f"Expected column '{amenity_type_column}' in amenities layer.")
 
-    amenities["amenity_type"] = (
-        amenities[amenity_type_column]
-        .astype(str)
+    # Normalize the handful of unique labels rather than every row. Labels are
+    # stringified first, so null values still count as type "none"; only labels
+    # that normalize to "nan" are treated as missing
+    raw_types = amenities[amenity_type_column].astype(str).astype("category")
+    normalized = (
+        raw_types.cat.categories
         .str.strip()
         .str.lower()
         .str.replace(" ", "_", regex=False)
         .str.replace("/", "_", regex=False)
-        .replace({"nan": None})
-    )
-    amenities = amenities[~amenities["amenity_type"].isna()]
-
-    logging.info("Running spatial join between amenities and building buffers...")
-    joined = gpd.sjoin(
-        amenities.set_geometry("geometry"),
-        buildings.set_geometry("buffer_m")[["building_id", "buffer_m", "geometry"]],
-        predicate="within",
-        how="left",
     )
-
-    logging.info("Aggregating counts per building and amenity type...")
-    counts = (
-        joined.dropna(subset=["building_id"])
-        .groupby(["building_id", "amenity_type"])
-        .size()
-        .reset_index(name="count")
+    type_map = {raw: norm for raw, norm in zip(raw_types.cat.categories, normalized) if norm != "nan"}
+    amenities["amenity_type"] = raw_types.map(type_map).astype(
+        pd.CategoricalDtype(sorted(set(type_map.values())))
     )
+    amenities = amenities[~amenities["amenity_type"].isna()]
 
-    pivot = counts.pivot(index="building_id", columns="amenity_type", values="count").fillna(0)
-    pivot.columns = [f"amen_{str(c).replace(' ', '_')}" for c in pivot.columns]
-    pivot = pivot.reset_index()
+    logging.info("Counting amenities per building and amenity type...")
+    # Accumulate straight into a (building, amenity type) int matrix instead of
+    # groupby -> pivot -> float fillna -> merge. Amenities are matched in chunks
+    # so only one chunk's candidate pairs are in memory at a time.
+    amenity_types = amenities["amenity_type"].cat.categories
+    type_codes = amenities["amenity_type"].cat.codes.to_numpy()
+    amenity_geoms = np.asarray(amenities.geometry.values)
+    # get_x/get_y are NaN for anything but a Point, so the contains_xy shortcut
+    # is only safe when every amenity is one
+    all_points = bool((shapely.get_type_id(amenity_geoms) == 0).all())
+    counts = np.zeros((len(buildings), len(amenity_types)), dtype=np.int32)
+    for start in range(0, len(amenity_geoms), AMENITY_CHUNK_SIZE):
+        chunk = amenity_geoms[start:start + AMENITY_CHUNK_SIZE]
+        if all_points:
+            # Take bounding-box candidates from the tree, then run the
+            # point-in-polygon test on raw coordinates with contains_xy
+            amenity_pos, building_pos = buffer_tree.query(chunk)
+            inside = shapely.contains_xy(
+                buffers[building_pos],
+                shapely.get_x(chunk)[amenity_pos],
+                shapely.get_y(chunk)[amenity_pos],
+            )
+            amenity_pos, building_pos = amenity_pos[inside], building_pos[inside]
+        else:
+            amenity_pos, building_pos = buffer_tree.query(chunk, predicate="within")
+        np.add.at(counts, (building_pos, type_codes[start + amenity_pos]), 1)
 
     logging.info("Merging accessibility metrics back to buildings...")
-    buildings = buildings.merge(pivot, on="building_id", how="left")
-    metric_cols = [c for c in buildings.columns if c.startswith("amen_")]
-    for c in metric_cols:
-        buildings[c] = buildings[c].fillna(0).astype(int)
-    buildings["num_amenities"] = buildings[metric_cols].sum(axis=1).astype(int)
+    # Only types with at least one match get a column, as with the old pivot;
+    # all count columns stay int32 so the output schema doesn't change
+    matched = counts.any(axis=0)
+    metric_cols = [f"amen_{str(c).replace(' ', '_')}" for c in amenity_types[matched]]
+    buildings[metric_cols] = counts[:, matched]
+    buildings["num_amenities"] = counts.sum(axis=1, dtype=np.int32)
 
     if trees_gdf is not None:
         logging.info("Computing num_trees per building...")
-        tree_join = gpd.sjoin(
-            trees_gdf,
-            buildings.set_geometry("buffer_m")[["building_id", "buffer_m"]],
-            predicate="within",
-            how="left",
-        )
-        tree_counts = tree_join.dropna(subset=["building_id"]).groupby("building_id").size()
-        buildings["num_trees"] = buildings["building_id"].map(tree_counts).fillna(0).astype(int)
+        # Same test as tree "within" buffer, but run as a prepared "contains"
+        # on the buffers; GEOS gains nothing from preparing the tree side
+        tree_geoms = np.asarray(trees_gdf.geometry.values)
+        tree_pos, buffer_pos = buffer_tree.query(tree_geoms)
+        shapely.prepare(buffers)
+        inside = shapely.contains(buffers[buffer_pos], tree_geoms[tree_pos])
+        buildings["num_trees"] = np.bincount(buffer_pos[inside], minlength=len(buildings)).astype(np.int32)
     else:
-        buildings["num_trees"] = 0
+        buildings["num_trees"] = np.zeros(len(buildings), dtype=np.int32)
 
-    to_export = buildings.drop(columns=["buffer_m"], errors="ignore")
-    geom_cols = [c for c in to_export.columns if c != to_export.geometry.name and hasattr(to_export[c].dtype, "name") and str(to_export[c].dtype.name).lower() == "geometry"]
-    for c in geom_cols:
-        to_export = to_export.drop(columns=[c])
+    to_export = buildings
+    geom_cols = to_export.select_dtypes(include="geometry").columns.difference([to_export.geometry.name])
+    to_export = to_export.drop(columns=geom_cols)
     to_export = _unique_columns(to_export)
     buildings_wgs84 = to_export.to_crs(epsg=4326)
     amenities_wgs84 = amenities.to_crs(epsg=4326)
 
-    buildings_out = OUTPUT_DIR / "buildings_accessibility.geojson"
+    # Full-detail outputs go to OUTPUT_DIR in binary formats (FlatGeobuf with a
+    # spatial index, GeoParquet); GeoJSON is only written for the website below
+    buildings_out = OUTPUT_DIR / "buildings_accessibility.fgb"
     logging.info("Writing buildings with accessibility metrics: %s", buildings_out)
-    buildings_wgs84.to_file(buildings_out, driver="GeoJSON")
+    write_layer(buildings_wgs84, buildings_out)
 
     # Filter amenities: exclude invalid types and null geometries
     amenities_filtered = amenities_wgs84[
@@ -392,40 +461,34 @@ def compute_building_accessibility(
     amenity_cols = [c for c in AMENITY_KEEP_COLUMNS if c in amenities_filtered.columns]
     amenities_filtered = amenities_filtered[amenity_cols]
     
-    amenities_all_path = OUTPUT_DIR / "amenities_all.geojson"
-    amenities_filtered.to_file(amenities_all_path, driver="GeoJSON")
+    # One file for all types; heatmap layers select by the amenity_type column
+    amenities_all_path = OUTPUT_DIR / "amenities_all.parquet"
+    amenities_filtered.to_parquet(amenities_all_path, index=False)
     logging.info("Wrote %s (%d features)", amenities_all_path, len(amenities_filtered))
 
-    logging.info("Writing per-amenity-type point layers for heatmaps...")
-    for amen_type, subset in amenities_filtered.groupby("amenity_type"):
-        safe_name = str(amen_type).replace(" ", "_").replace("/", "_").replace("\\", "_")
-        out_path = OUTPUT_DIR / f"amenities_{safe_name}.geojson"
-        logging.info("  %s: %d features -> %s", amen_type, len(subset), out_path)
-        subset.to_file(out_path, driver="GeoJSON")
-
     trees_wgs84 = None
     if trees_gdf is not None:
         # Compute centroids in projected CRS (metric) then convert to WGS84
         trees_gdf = trees_gdf.set_geometry(trees_gdf.geometry.centroid)
         trees_wgs84 = trees_gdf.to_crs(epsg=4326)
-        out_trees = OUTPUT_DIR / "trees.geojson"
-        trees_wgs84.to_file(out_trees, driver="GeoJSON")
+        out_trees = OUTPUT_DIR / "trees.fgb"
+        write_layer(trees_wgs84, out_trees)
         logging.info("Wrote %s", out_trees)
     
-    parks_wgs84 = None
     if parks_gdf is not None:
         parks_wgs84 = parks_gdf.to_crs(epsg=4326)
-        out_parks = OUTPUT_DIR / "parks.geojson"
-        parks_wgs84.to_file(out_parks, driver="GeoJSON")
+        out_parks = OUTPUT_DIR / "parks.fgb"
+        write_layer(parks_wgs84, out_parks)
         logging.info("Wrote %s", out_parks)
 
     # Write web-accessible files to docs/data/ for website deployment
     logging.info("Writing web files to docs/data/...")
     DOCS_DATA_DIR.mkdir(exist_ok=True)
     
-    # Simplify building geometries for web (reduces file size significantly)
+    # Simplify building geometries for web (reduces file size significantly).
+    # Done in the metric CRS the buildings are already in, then reprojected once.
     logging.info("Simplifying building geometries (tolerance: %.1fm)...", BUILDING_SIMPLIFY_TOLERANCE_M)
-    buildings_web = simplify_geometries(buildings_wgs84, BUILDING_SIMPLIFY_TOLERANCE_M)
+    buildings_web = simplify_geometries(to_export, BUILDING_SIMPLIFY_TOLERANCE_M).to_crs(epsg=4326)
     buildings_web = reduce_coordinate_precision(buildings_web, precision=5)
     
     # Drop unused columns from buildings
@@ -459,9 +522,9 @@ def compute_building_accessibility(
         trees_file_size = (DOCS_DATA_DIR / "trees.geojson").stat().st_size
         logging.info("Trees: %.1fMB (%d features, geometry only)", trees_file_size / 1e6, len(trees_web))
     
-    if parks_wgs84 is not None:
+    if parks_gdf is not None:
         # Also simplify park geometries (usually large polygons, can use higher tolerance)
-        parks_web = simplify_geometries(parks_wgs84, PARK_SIMPLIFY_TOLERANCE_M)
+        parks_web = simplify_geometries(parks_gdf, PARK_SIMPLIFY_TOLERANCE_M).to_crs(epsg=4326)
         write_minimal_geojson(parks_web, DOCS_DATA_DIR / "parks.geojson", precision=5)
         parks_file_size = (DOCS_DATA_DIR / "parks.geojson").stat().st_size
         logging.info("Parks: %.1fMB (%d features)", parks_file_size / 1e6, len(parks_web))